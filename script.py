@@ -1,104 +1,172 @@
 import io
 import re
 import csv
-from typing import Dict, List, Tuple, Set
+import gc
+import sys
+import tempfile
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Protocol, Sequence, Tuple
 
 import streamlit as st
 from openpyxl import load_workbook, Workbook
-from openpyxl.worksheet.worksheet import Worksheet
+from openpyxl.utils import get_column_letter
 
 # ----------------- utils -----------------
 
+# (day_name, period_number, class) -> "(科目 老師)"
+TimetableMap = Dict[Tuple[str, int, str], str]
+
+class RowWriter(Protocol):
+    """Anything with csv.writer's writerow, e.g. the unmatched-lines report."""
+    def writerow(self, row: Iterable[Any]) -> Any: ...
+
 DAY_MAP = {"一": "星期一", "二": "星期二", "三": "星期三", "四": "星期四", "五": "星期五"}
 
+_WS_RE = re.compile(r"\s+")
+_WS2_RE = re.compile(r"\s{2,}")
+_CLASS_HEADER_RE = re.compile(r"\d+[A-E]")
+_DASH_SET = {"", "-", "—", "–", "－"}
+_DASH_CHARS = " -—–－"
+
 def _clean(x) -> str:
+    # fast path: most timetable cells are empty or a bare dash
     if x is None:
         return ""
-    s = str(x).strip()
-    if s in {"-", "—", "–", "－"} or s.strip(" -—–－") == "":
+    if type(x) is not str:
+        x = str(x)
+    if x in _DASH_SET:
         return ""
-    return re.sub(r"\s+", " ", s)
+    s = x.strip()
+    if not s.strip(_DASH_CHARS):
+        return ""
+    # only a space run or a non-space whitespace char (all non-printable) needs collapsing
+    if "  " in s or not s.isprintable():
+        s = _WS_RE.sub(" ", s)
+    return s
+
+def _value_at(row: Sequence, col: int):
+    """1-based column lookup on a values_only row; short (ragged) rows read as empty."""
+    return row[col - 1] if col <= len(row) else None
 
-def find_class_columns(ws: Worksheet) -> Dict[str, int]:
+def find_class_columns(header: Sequence) -> Dict[str, int]:
     """Row 1 has headers like '1A','2C'... Data is in the SAME (left) column of merged pairs."""
     class_cols = {}
-    for c in range(1, ws.max_column + 1):
-        v = ws.cell(1, c).value
-        if isinstance(v, str) and re.fullmatch(r"\d+[A-E]", v):
+    for c, v in enumerate(header, start=1):
+        if isinstance(v, str) and _CLASS_HEADER_RE.fullmatch(v):
             class_cols[v] = c
     return class_cols
 
-def build_mapping(file_a_bytes: bytes) -> Dict[str, Dict[int, Dict[str, str]]]:
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_mapping(file_a_bytes: bytes) -> TimetableMap:
     """
     From school_timetable.xlsx build:
-      map[day_name][period_number][class] = "(科目 老師)"
+      map[(day_name, period_number, class)] = "(科目 老師)"
     Col A = period #, subject on that row, teacher at +2 rows.
     """
-    wb = load_workbook(io.BytesIO(file_a_bytes), data_only=True)
-    result: Dict[str, Dict[int, Dict[str, str]]] = {}
-    for ws in wb.worksheets:
-        class_cols = find_class_columns(ws)
-        day_map: Dict[int, Dict[str, str]] = {}
-        for r in range(1, ws.max_row + 1):
-            a = ws.cell(r, 1).value
-            if isinstance(a, int):  # period id
-                period_num = a
-                for cls, col in class_cols.items():
-                    subject = _clean(ws.cell(r, col).value)
-                    teacher = _clean(ws.cell(r + 2, col).value) if r + 2 <= ws.max_row else ""
-                    if not subject and not teacher:
-                        continue
-                    suffix = f"({subject} {teacher})".strip()
-                    suffix = re.sub(r"\s{2,}", " ", suffix)
-                    day_map.setdefault(period_num, {})[cls] = suffix
-        result[ws.title] = day_map
+    # read_only streams the sheet XML instead of building the full cell graph;
+    # rows are buffered so the teacher row (+2) can still be reached by index.
+    wb = load_workbook(io.BytesIO(file_a_bytes), read_only=True, data_only=True)
+    result: TimetableMap = {}
+    try:
+        for ws in wb.worksheets:
+            # the file's <dimension> tag may understate the used range; every row is read anyway
+            ws.reset_dimensions()
+            rows = list(ws.iter_rows(values_only=True))
+            n_rows = len(rows)
+            class_cols = find_class_columns(rows[0]) if rows else {}
+            for r, row in enumerate(rows):
+                a = row[0] if row else None
+                if isinstance(a, int):  # period id
+                    period_num = a
+                    teacher_row = rows[r + 2] if r + 2 < n_rows else ()
+                    for cls, col in class_cols.items():
+                        subject = _clean(_value_at(row, col))
+                        teacher = _clean(_value_at(teacher_row, col))
+                        if not subject and not teacher:
+                            continue
+                        suffix = f"({subject} {teacher})".strip()
+                        # many classes share a suffix (e.g. whole-grade PE); keep one copy of each
+                        suffix = sys.intern(_WS2_RE.sub(" ", suffix))
+                        result[(ws.title, period_num, cls)] = suffix
+    finally:
+        wb.close()
     return result
 
-CLASS_TOKEN = re.compile(r"(\d+[A-E])(?:\d+)?")  # class (1A..6E) with optional student number
+# class (1A..6E); a trailing student number is left unmatched since only group 1 is used
+CLASS_TOKEN = re.compile(r"(\d+[A-E])")
+# a whole line (no newline) containing a class token; group 1 is the first class on the line
+CLASS_LINE = re.compile(r"^[^\n]*?" + CLASS_TOKEN.pattern + r"[^\n]*", re.M)
+
+def _annotate_text(text: str, suffix_by_cls: Dict[str, str]) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Pure-string kernel (no openpyxl objects): put each class line's suffix on the NEXT LINE.
+    Returns the new text and the (class, line) pairs with no suffix.
+    """
+    misses = []
+
+    def repl(m: re.Match) -> str:
+        line, cls = m.group(0), m.group(1)
+        suffix = suffix_by_cls.get(cls)
+        if not suffix:
+            misses.append((cls, line))
+            return line
+        # already annotated: suffix at the tail of the line, or as the line right after it
+        if line.endswith(suffix) or text.startswith(suffix, m.end() + 1):
+            return line
+        # put suffix on a new line
+        return f"{line}\n{suffix}"
+
+    return CLASS_LINE.sub(repl, text), misses
+
+def _index_by_day(mapping: TimetableMap) -> Dict[str, Dict[int, Dict[str, str]]]:
+    """Group the flat mapping into day -> period -> {class: suffix} slices for the kernel."""
+    by_day: Dict[str, Dict[int, Dict[str, str]]] = {}
+    for (day, period, cls), suffix in mapping.items():
+        by_day.setdefault(day, {}).setdefault(period, {})[cls] = suffix
+    return by_day
 
 def annotate_schedule(wb: Workbook,
-                      mapping: Dict[str, Dict[int, Dict[str, str]]]) -> Tuple[int, List[Tuple]]:
+                      mapping: TimetableMap,
+                      unmatched_writer: RowWriter) -> Tuple[int, int]:
     """
     Append suffix using (day, period_number, class),
     but place suffix on the NEXT LINE.
+    Unmatched lines are written to unmatched_writer as they are found.
+    Returns (number of changed cells, number of unmatched lines).
     """
     ws = wb.active
-    day_headers = [ws.cell(2, c).value for c in range(2, ws.max_column + 1)]
+    mx_row, mx_col = ws.max_row, ws.max_column
+    header = next(ws.iter_rows(min_row=2, max_row=2, max_col=mx_col, values_only=True), ())
+    day_headers = header[1:]
     day_names = [DAY_MAP.get(v, v) for v in day_headers]
 
-    unmatched = []
+    # bind each column's day slice once, outside the row loop
+    by_day = _index_by_day(mapping)
+    col_day_maps = [by_day.get(day_name, {}) for day_name in day_names]
+    # column letters for the unmatched report, aligned with row[1:]
+    col_letters = [get_column_letter(c) for c in range(2, mx_col + 1)]
+    unmatched = 0
     changed = 0
 
-    for r in range(3, ws.max_row + 1):
-        a = ws.cell(r, 1).value
+    # one row-wise pass; Cell objects are kept (values_only=False) so they can be written back
+    for row in ws.iter_rows(min_row=3, max_row=mx_row, max_col=mx_col):
+        a = row[0].value
         if not isinstance(a, int):
             continue
         period_num = a
-        for c_idx, day_name in enumerate(day_names, start=2):
-            cell = ws.cell(r, c_idx)
+        r = row[0].row
+        # period is constant across the row: resolve each column's {class: suffix} slice up front
+        period_slices = [day_map.get(period_num, {}) for day_map in col_day_maps]
+        for cell, day_name, suffix_by_cls, col_letter in zip(row[1:], day_names, period_slices, col_letters):
             text = cell.value
-            if not isinstance(text, str) or not text.strip():
+            # most cells (blank, headers, notes) have no class token at all
+            if not isinstance(text, str) or not CLASS_TOKEN.search(text):
                 continue
 
-            lines = text.splitlines()
-            new_lines = []
-            for line in lines:
-                m = CLASS_TOKEN.search(line)
-                if not m:
-                    new_lines.append(line); continue
-                cls = m.group(1)
-                suffix = mapping.get(day_name, {}).get(period_num, {}).get(cls)
-                if not suffix:
-                    unmatched.append((ws.title, r, cell.coordinate, day_name, period_num, cls, line))
-                    new_lines.append(line)
-                else:
-                    if suffix in line:
-                        new_lines.append(line)
-                    else:
-                        # put suffix on a new line
-                        new_lines.append(f"{line}\n{suffix}")
-
-            new_text = "\n".join(new_lines)
+            new_text, misses = _annotate_text(text, suffix_by_cls)
+            for cls, line in misses:
+                unmatched_writer.writerow((ws.title, r, f"{col_letter}{r}", day_name, period_num, cls, line))
+                unmatched += 1
             if new_text != text:
                 cell.value = new_text
                 changed += 1
@@ -117,26 +185,33 @@ file_b = st.file_uploader("上傳 september_st_timetable.xlsx（待標註，第
 if st.button("開始標註", type="primary", disabled=not (file_a and file_b)):
     try:
         with st.spinner("讀取並建立對照表…"):
-            timetable_map = build_mapping(file_a.read())
-            total_keys = sum(len(v) for v in timetable_map.values())
+            timetable_map = build_mapping(file_a.getvalue())
+            total_keys = len({(day, p) for day, p, _ in timetable_map})
             st.success(f"完成：{total_keys} 個節次載入。")
 
         file_b.seek(0)
         wb = load_workbook(file_b, data_only=True)
 
-        with st.spinner("套用標註…"):
-            changed, unmatched = annotate_schedule(wb, timetable_map)
-
-        # Export outputs
-        out_xlsx = io.BytesIO()
-        wb.save(out_xlsx); out_xlsx.seek(0)
-
-        csv_buf = io.StringIO()
-        w = csv.writer(csv_buf); w.writerow(["sheet","row","cell","day","period","class","line"])
-        for row in unmatched: w.writerow(row)
-        csv_bytes = csv_buf.getvalue().encode("utf-8")
-
-        st.success(f"已更新 {changed} 個儲存格。未匹配：{len(unmatched)}")
+        # unmatched rows are spooled to disk as they are found, so a mismatched File A can't balloon RAM
+        with tempfile.TemporaryFile("w+b") as csv_raw:
+            csv_file = io.TextIOWrapper(csv_raw, encoding="utf-8", newline="")
+            w = csv.writer(csv_file); w.writerow(["sheet","row","cell","day","period","class","line"])
+            with st.spinner("套用標註…"):
+                changed, unmatched = annotate_schedule(wb, timetable_map, w)
+
+            # Export outputs
+            out_xlsx = io.BytesIO()
+            wb.save(out_xlsx); out_xlsx.seek(0)
+            # Workbook <-> Worksheet references form a cycle, so the cell model is only freed by a collection
+            del wb
+            gc.collect()
+
+            # detach flushes the text layer without closing csv_raw; read the utf-8 bytes back as-is
+            csv_file.detach()
+            csv_raw.seek(0)
+            csv_bytes = csv_raw.read()
+
+        st.success(f"已更新 {changed} 個儲存格。未匹配：{unmatched}")
         st.download_button("⬇️ 下載已標註 Excel", data=out_xlsx,
                            file_name="september_st_timetable_annotated.xlsx",
                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
@@ -144,14 +219,8 @@ if st.button("開始標註", type="primary", disabled=not (file_a and file_b)):
                            file_name="unmatched_keys.csv", mime="text/csv")
 
         if st.checkbox("查看部分對照表（預覽 30 條）"):
-            sample = {}
-            for day, by_period in timetable_map.items():
-                for p, by_cls in by_period.items():
-                    for cls, suf in by_cls.items():
-                        sample[f"{day} 第{p}節 {cls}"] = suf
-                        if len(sample) >= 30: break
-                    if len(sample) >= 30: break
-                if len(sample) >= 30: break
+            sample = {f"{day} 第{p}節 {cls}": suf
+                      for (day, p, cls), suf in islice(timetable_map.items(), 30)}
             st.write(sample)
 
     except Exception as e: